@@ -14,12 +14,22 @@ __version__ = '2.2'
 
 #Standard imports
 from time import sleep
+import time
 from shutil import copy2
 import pygame
 import sys
 import datetime
+import json
 import os
-import keyboard
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue # Python 2
+
+#Unlike time.time(), time.monotonic() isn't affected by the system clock being changed (e.g. by NTP),
+#but it isn't available on Python 2
+monotonic = getattr(time, 'monotonic', time.time)
 
 #Need to do this early, in case import below fails:
 REAL_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -29,7 +39,7 @@ try:
     from PIL import Image
     from ruamel import yaml
     import picamera
-    import RPi.GPIO as GPIO
+    from gpiozero import Button
 
 except ImportError as missing_module:
     print('--------------------------------------------')
@@ -49,6 +59,11 @@ except ImportError as missing_module:
 #############################
 PATH_TO_CONFIG = REAL_PATH + '/camera-config.yaml'
 PATH_TO_CONFIG_EXAMPLE = REAL_PATH + '/camera-config.example.yaml'
+PATH_TO_CONFIG_CACHE = PATH_TO_CONFIG + '.json'
+
+#Cache the parsed config as JSON (which is much quicker to load than YAML).
+#Set to False to always re-read [camera-config.yaml], e.g. during development.
+USE_CONFIG_CACHE = True
 
 #Check if config file exists
 if not os.path.exists(PATH_TO_CONFIG):
@@ -56,13 +71,69 @@ if not os.path.exists(PATH_TO_CONFIG):
     print('Config file was not found. Creating:' + PATH_TO_CONFIG)
     copy2(PATH_TO_CONFIG_EXAMPLE, PATH_TO_CONFIG)
 
-#Read config file using YAML interpreter
-with open(PATH_TO_CONFIG, 'r') as stream:
-    CONFIG = {}
+    #Discard any config cached from the previous config file
+    if os.path.exists(PATH_TO_CONFIG_CACHE):
+        os.remove(PATH_TO_CONFIG_CACHE)
+
+def load_cached_config(config_version):
+    """
+    Returns the cached config, or None if the cache is missing, unreadable or out of date.
+    """
+    if not os.path.exists(PATH_TO_CONFIG_CACHE):
+        return None
+
+    try:
+        with open(PATH_TO_CONFIG_CACHE, 'r') as cache_file:
+            cached = json.load(cache_file)
+    except (IOError, OSError, ValueError) as exc:
+        print('Unable to read config cache: ' + str(exc))
+        return None
+
+    if isinstance(cached, dict) and cached.get('version') == config_version:
+        return cached.get('config')
+    return None
+
+def save_cached_config(config, config_version):
+    """
+    Write the config to the cache (if it can be represented as JSON).
+    """
     try:
-        CONFIG = yaml.safe_load(stream)
-    except yaml.YAMLError as exc:
-        print(exc)
+        cache_data = json.dumps({'version': config_version, 'config': config})
+
+        #Write to a temporary file first, so a partially written cache is never left behind
+        temp_path = PATH_TO_CONFIG_CACHE + '.tmp'
+        with open(temp_path, 'w') as cache_file:
+            cache_file.write(cache_data)
+        os.rename(temp_path, PATH_TO_CONFIG_CACHE)
+    except (TypeError, ValueError) as exc:
+        #e.g. the config contains a value (such as a date) that JSON cannot represent
+        print('Unable to cache config: ' + str(exc))
+    except (IOError, OSError) as exc:
+        print('Unable to write config cache: ' + str(exc))
+
+CONFIG = None
+
+#The cache records the config file's modification time and size,
+#and is only used if both still match exactly.
+#(Copying tools may preserve an older mtime, so "newer than" isn't sufficient)
+CONFIG_VERSION = [os.path.getmtime(PATH_TO_CONFIG), os.path.getsize(PATH_TO_CONFIG)]
+
+#Read cached config
+if USE_CONFIG_CACHE:
+    CONFIG = load_cached_config(CONFIG_VERSION)
+
+if CONFIG is None:
+    #Read config file using YAML interpreter
+    with open(PATH_TO_CONFIG, 'r') as stream:
+        CONFIG = {}
+        try:
+            CONFIG = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            print(exc)
+
+    #Update the cached config
+    if USE_CONFIG_CACHE and CONFIG:
+        save_cached_config(CONFIG, CONFIG_VERSION)
 
 #Required config
 try:
@@ -103,8 +174,10 @@ except KeyError as exc:
     pass
 
 
-pygame.init()
-pygame.mixer.init()
+#Only the mixer is used, so the other pygame subsystems (display, fonts, etc.) are not initialised.
+#(Anything that needs them should call their own init(), e.g. pygame.font.init())
+#A small buffer reduces the latency before a sound starts playing.
+pygame.mixer.init(frequency=22050, size=-16, channels=2, buffer=512)
 SOUND_COUNTDOWN_0 = './assets/sounds/vous-allez-me-montrer-ce-que-vous-avez-un-peu-dans-le-froc.mp3'
 SOUND_COUNTDOWN_1 = './assets/sounds/deshabillezvous.mp3'
 SOUND_COUNTDOWN_2 = './assets/sounds/allez-y-mollo-avec-la-joie.mp3'
@@ -120,13 +193,31 @@ SOUND_DONE_4 = './assets/sounds/pour_savoir_si_il_va_y_avoir_du_vent.mp3'
 SOUND_DONE_5 = './assets/sounds/sourire_comme_des_glands.mp3'
 SOUND_DONE_6 = './assets/sounds/vous-vous-devriez-arreter-de-sourire.mp3'
 
+COUNTDOWN_SOUNDS = (SOUND_COUNTDOWN_0, SOUND_COUNTDOWN_1, SOUND_COUNTDOWN_2, SOUND_COUNTDOWN_3)
+DONE_SOUNDS = (SOUND_DONE_0, SOUND_DONE_1, SOUND_DONE_2, SOUND_DONE_3, SOUND_DONE_4, SOUND_DONE_5, SOUND_DONE_6)
+
+#Decode each sound once, so that playback can start immediately
+#(Note: mp3 support for pygame.mixer.Sound requires pygame 2)
+SOUNDS = {}
+for sound_file in (SOUND_CAMERA,) + COUNTDOWN_SOUNDS + DONE_SOUNDS:
+    SOUNDS[sound_file] = pygame.mixer.Sound(sound_file)
+
 ##############################
 ### Setup Objects and Pins ###
 ##############################
 #Setup GPIO
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(CAMERA_BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(EXIT_BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+CAMERA_BUTTON = Button(CAMERA_BUTTON_PIN, pull_up=True, bounce_time=DEBOUNCE_TIME)
+EXIT_BUTTON = Button(EXIT_BUTTON_PIN, pull_up=True, bounce_time=DEBOUNCE_TIME)
+
+#Buttons are added (from gpiozero's thread) whenever they are pressed
+PRESSED_BUTTONS = queue.Queue()
+
+def on_button_pressed(button):
+    """Queue a button press, for wait_for_button()."""
+    PRESSED_BUTTONS.put(button)
+
+CAMERA_BUTTON.when_pressed = on_button_pressed
+EXIT_BUTTON.when_pressed = on_button_pressed
 
 CAMERA = picamera.PiCamera()
 CAMERA.rotation = CAMERA_ROTATION
@@ -134,30 +225,89 @@ CAMERA.annotate_text_size = 80
 CAMERA.resolution = (PHOTO_W, PHOTO_H)
 CAMERA.hflip = CAMERA_HFLIP
 
+#Static overlays, (path, mode), which are prepared once at startup
+OVERLAY_ASSETS = [
+    (REAL_PATH + '/assets/Bienvenue.png', 'RGB'),
+    (REAL_PATH + '/assets/souriez.png', 'RGBA'),
+    (REAL_PATH + '/assets/all_done.png', 'RGB'),
+]
+OVERLAY_ASSETS.extend(
+    (REAL_PATH + '/assets/wait-' + str(counter) + '.png', 'RGBA') for counter in range(COUNTDOWN, 0, -1)
+)
+OVERLAY_CACHE = {}
+
+#Overlays on this layer are hidden beneath the camera preview (which uses layer 2)
+HIDDEN_LAYER = 0
+
 ########################
 ### Helper Functions ###
 ########################
 
 def play_sound(file):
-    pygame.mixer.music.load(file)
-    pygame.mixer.music.play()
+    SOUNDS[file].play()
 
 def health_test_required_folders():
     folders_list=[SAVE_RAW_IMAGES_FOLDER]
     folders_list.extend(COPY_IMAGES_TO)
-    folders_checked=[]
+    folders_checked=set()
 
     for folder in folders_list:
-        if folder not in folders_checked:
-            folders_checked.append(folder)
-        else:
+        if folder in folders_checked:
             print('ERROR: Cannot use same folder path ('+folder+') twice. Refer config file.')
+            continue
+        folders_checked.add(folder)
 
         #Create folder if doesn't exist
         if not os.path.exists(folder):
             print('Creating folder: ' + folder)
             os.makedirs(folder)
 
+def wait_for_button():
+    """
+    Block (without polling) until a button is pressed.
+    Any presses which occurred before this call are ignored.
+    Returns the button that was pressed.
+    """
+    #Discard presses made before now (e.g. during the previous photo)
+    try:
+        while True:
+            PRESSED_BUTTONS.get_nowait()
+    except queue.Empty:
+        pass
+
+    while True:
+        #(A timeout is used so that Ctrl-C can still interrupt the wait on Python 2)
+        try:
+            button = PRESSED_BUTTONS.get(timeout=1)
+        except queue.Empty:
+            continue
+
+        #Button is required to be "pressed in" for the debounce duration
+        sleep(DEBOUNCE_TIME)
+
+        #If both buttons are pressed, exiting takes priority
+        if EXIT_BUTTON.is_pressed:
+            return EXIT_BUTTON
+        if button.is_pressed:
+            return button
+
+def copy_images_to_folder(photo_filenames, dest):
+    """Copy each of the photos into a single folder."""
+    for src in photo_filenames:
+        print(src + ' -> ' + dest)
+        copy2(src, dest)
+
+def copy_images(photo_filenames):
+    """
+    Copy photos into each of the additional folders (COPY_IMAGES_TO).
+    Each folder is copied to in its own background thread, so that slow
+    destinations (e.g. USB sticks, network shares) are copied to concurrently,
+    and do not delay the next photo.
+    """
+    for dest in COPY_IMAGES_TO:
+        thread = threading.Thread(target=copy_images_to_folder, args=(list(photo_filenames), dest))
+        thread.start()
+
 def print_overlay(string_to_print):
     """
     Writes a string to both [i] the console, and [ii] CAMERA.annotate_text
@@ -177,9 +327,7 @@ def get_base_filename_for_images():
     ${ProjectRoot}/photos/2017-12-31_23-59-59_1of4.png, being used as a filename.
     """
 
-    base_filename = str(datetime.datetime.now()).split('.')[0]
-    base_filename = base_filename.replace(' ', '_')
-    base_filename = base_filename.replace(':', '-')
+    base_filename = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
 
     base_filepath = REAL_PATH + '/' + SAVE_RAW_IMAGES_FOLDER + '/' + base_filename + '.jpg'
 
@@ -192,23 +340,39 @@ def remove_overlay(overlay_id):
     if overlay_id != -1:
         CAMERA.remove_overlay(overlay_id)
 
-# overlay one image on screen
-def overlay_image(image_path, duration=0, layer=3, mode='RGB'):
+def is_opaque(img):
     """
-    Add an overlay (and sleep for an optional duration).
-    If sleep duration is not supplied, then overlay will need to be removed later.
-    This function returns an overlay id, which can be used to remove_overlay(id).
+    Returns True if the image has no transparent (or translucent) pixels.
+    """
+    if 'A' not in img.getbands() and 'transparency' not in img.info:
+        return True
+
+    # Minimum value of the alpha channel
+    return img.convert('RGBA').split()[-1].getextrema()[0] == 255
+
+def prepare_overlay(image_path, mode='RGB', cache=True):
+    """
+    Load an image, and prepare the padded data required for an overlay.
+    Unless cache is False, the result is stored in OVERLAY_CACHE (keyed by image path),
+    so that static assets only need to be decoded once.
+    When caching, an 'RGBA' overlay that is fully opaque is prepared as 'RGB' instead,
+    so that less data needs to be sent to the GPU.
+    Returns a tuple of (padded_img_data, size, mode).
     """
 
     # Load the (arbitrarily sized) image
     img = Image.open(image_path)
 
     if( img.size[0] > SCREEN_W):
-        # To avoid memory issues associated with large images, we are going to resize image to match our screen's size:
+        # To avoid memory issues associated with large images, we are going to resize image to match our screen's size.
+        # (Bilinear is much quicker than antialiasing, and is good enough for an image shown for a few seconds)
         basewidth = SCREEN_W
         wpercent = (basewidth/float(img.size[0]))
         hsize = int((float(img.size[1])*float(wpercent)))
-        img = img.resize((basewidth,hsize), Image.ANTIALIAS)
+        img = img.resize((basewidth,hsize), Image.BILINEAR)
+
+    if cache and mode == 'RGBA' and is_opaque(img):
+        mode = 'RGB'
 
     # "
     #   The camera`s block size is 32x16 so any image data
@@ -218,15 +382,28 @@ def overlay_image(image_path, duration=0, layer=3, mode='RGB'):
     # "
     # Refer:
     # http://picamera.readthedocs.io/en/release-1.10/recipes1.html#overlaying-images-on-the-preview
-
-    # Create an image padded to the required size with mode 'RGB' / 'RGBA'
-    pad = Image.new(mode, (
-        ((img.size[0] + 31) // 32) * 32,
-        ((img.size[1] + 15) // 16) * 16,
-    ))
-
-    # Paste the original image into the padded one
-    pad.paste(img, (0, 0))
+    #
+    # Note: MMAL_PARAMETER_NO_IMAGE_PADDING cannot be used to avoid this.
+    # It only applies to the camera's output ports, whereas the overlay
+    # renderer's input port is created (and fed) within add_overlay().
+
+    needs_pad = (img.size[0] % 32) or (img.size[1] % 16)
+
+    if needs_pad:
+        # Create an image padded to the required size with mode 'RGB' / 'RGBA'
+        # (round up to the VideoCore's 32x16 block size, using bit masks)
+        pad_w = (img.size[0] + 31) & ~31
+        pad_h = (img.size[1] + 15) & ~15
+        pad = Image.new(mode, (pad_w, pad_h))
+
+        # Paste the original image into the padded one
+        pad.paste(img, (0, 0))
+    elif img.mode != mode:
+        # Already aligned, just convert to 'RGB' / 'RGBA'
+        pad = img.convert(mode)
+    else:
+        # Already aligned, and in the required mode
+        pad = img
 
     #Get the padded image data
     try:
@@ -234,9 +411,45 @@ def overlay_image(image_path, duration=0, layer=3, mode='RGB'):
     except AttributeError:
         padded_img_data = pad.tostring() # Note: tostring() is deprecated in PIL v3.x
 
+    overlay = (padded_img_data, img.size, mode)
+    if cache:
+        OVERLAY_CACHE[image_path] = overlay
+    return overlay
+
+def preload_overlays():
+    """
+    Prepare the overlays for each of the (static) assets, ahead of time.
+    """
+    for image_path, mode in OVERLAY_ASSETS:
+        if os.path.exists(image_path):
+            prepare_overlay(image_path, mode)
+        else:
+            print('WARNING: Overlay asset not found: ' + image_path)
+
+def get_overlay(image_path, mode='RGB'):
+    """
+    Returns the (padded_img_data, size, mode) for an image.
+    Uses the preloaded overlay if available (otherwise, e.g. for captured photos, prepares it now).
+    Note: a preloaded overlay may use 'RGB' instead of the requested mode (refer prepare_overlay).
+    """
+    overlay = OVERLAY_CACHE.get(image_path)
+    if overlay is None:
+        overlay = prepare_overlay(image_path, mode, cache=False)
+    return overlay
+
+# overlay one image on screen
+def overlay_image(image_path, duration=0, layer=3, mode='RGB'):
+    """
+    Add an overlay (and sleep for an optional duration).
+    If sleep duration is not supplied, then overlay will need to be removed later.
+    This function returns an overlay id, which can be used to remove_overlay(id).
+    """
+
+    padded_img_data, size, mode = get_overlay(image_path, mode)
+
     # Add the overlay with the padded image as the source,
     # but the original image's dimensions
-    o_id = CAMERA.add_overlay(padded_img_data, size=img.size)
+    o_id = CAMERA.add_overlay(padded_img_data, size=size)
     o_id.layer = layer
 
     if duration > 0:
@@ -264,14 +477,35 @@ def taking_photo(photo_number, filename):
     """
 
     #countdown from 3, and display countdown on screen
+    #(a single overlay is used, and its image is replaced each second,
+    # unless the image's size or mode differs from the previous one, which requires a new overlay)
+    countdown_overlay = -1
+    countdown_format = None
+    deadline = monotonic()
     for counter in range(COUNTDOWN, 0, -1):
         get_ready_image = REAL_PATH + '/assets/wait-' + str(counter) + '.png'
-        overlay_image(get_ready_image, 1, 3, 'RGBA')
+        padded_img_data, size, image_mode = get_overlay(get_ready_image, 'RGBA')
+        if (size, image_mode) != countdown_format:
+            previous_overlay = countdown_overlay
+            countdown_overlay = CAMERA.add_overlay(padded_img_data, size=size)
+            countdown_overlay.layer = 3
+            countdown_format = (size, image_mode)
+            remove_overlay(previous_overlay)
+        else:
+            # Reuses the overlay's renderer (and its buffer), rather than creating a new overlay
+            countdown_overlay.update(padded_img_data)
+
+        #Sleep until the next second is due, so time spent updating the overlay isn't added to the countdown
+        deadline += 1
+        sleep(max(0, deadline - monotonic()))
+    remove_overlay(countdown_overlay)
 
     #Take still
     play_sound(SOUND_CAMERA)
     CAMERA.annotate_text = ''
-    CAMERA.capture(filename)
+    # Capture from the (already running) video port, which avoids the delay
+    # (and preview blackout) of switching the sensor into still-capture mode
+    CAMERA.capture(filename, use_video_port=True, quality=90)
     print('Photo (' + str(photo_number) + ') saved: ' + filename)
     return filename
 
@@ -288,20 +522,7 @@ def playback_screen(filename):
     overlay_image(finished_image, 3)
 
 def done_sound(photo_number):
-    if(photo_number%7 == 0):
-        play_sound(SOUND_DONE_0)
-    elif(photo_number%7 == 1):
-        play_sound(SOUND_DONE_1)
-    elif(photo_number%7 == 2):
-        play_sound(SOUND_DONE_2)
-    elif(photo_number%7 == 3):
-        play_sound(SOUND_DONE_3)
-    elif(photo_number%7 == 4):
-        play_sound(SOUND_DONE_4)
-    elif(photo_number%7 == 5):
-        play_sound(SOUND_DONE_5)
-    elif(photo_number%7 == 6):
-        play_sound(SOUND_DONE_6)
+    play_sound(DONE_SOUNDS[photo_number % len(DONE_SOUNDS)])
 
 def main():
     """
@@ -321,70 +542,43 @@ def main():
     #Setup any required folders (if missing)
     health_test_required_folders()
 
+    #Decode the static overlays ahead of time
+    preload_overlays()
+
     #Start camera preview
     CAMERA.start_preview(resolution=(SCREEN_W, SCREEN_H))
 
     #Display intro screen
+    #(The intro and finished overlays are created once, and then hidden/shown
+    # by moving them beneath/above the preview's layer, which avoids
+    # re-creating an overlay renderer on every cycle)
     intro_image = REAL_PATH + '/assets/Bienvenue.png'
     overlay = overlay_image(intro_image, 0, 3)
-
-    #Wait for someone to push the button
-    i = 0
-    blink_speed = 10
-
-   #Use falling edge detection to see if button is being pushed in
-    GPIO.add_event_detect(CAMERA_BUTTON_PIN, GPIO.FALLING)
-    GPIO.add_event_detect(EXIT_BUTTON_PIN, GPIO.FALLING)
+    finished_image = REAL_PATH + '/assets/all_done.png'
+    finished_overlay = overlay_image(finished_image, 0, HIDDEN_LAYER)
 
     while True:
-        photo_button_is_pressed = None
-        exit_button_is_pressed = None
-
-        if GPIO.event_detected(CAMERA_BUTTON_PIN):
-            sleep(DEBOUNCE_TIME)
-            if GPIO.input(CAMERA_BUTTON_PIN) == 0:
-                photo_button_is_pressed = True
-
-        if GPIO.event_detected(EXIT_BUTTON_PIN):
-            sleep(DEBOUNCE_TIME)
-            if GPIO.input(EXIT_BUTTON_PIN) == 0:
-                exit_button_is_pressed = True
-
-        if exit_button_is_pressed is not None:
-            return #Exit the photo booth
-
+        #Wait for someone to push the button
         if TESTMODE_AUTOPRESS_BUTTON:
-            photo_button_is_pressed = True
+            button = CAMERA_BUTTON
+        else:
+            button = wait_for_button()
 
-        #Stay inside loop, until button is pressed
-        if photo_button_is_pressed is None:
-            #Regardless, restart loop
-            sleep(0.1)
-            continue
+        if button is EXIT_BUTTON:
+            return #Exit the photo booth
 
         #Button has been pressed!
         print('Button pressed! You folks are in for a treat.')
 
-        #Silence GPIO detection
-        GPIO.remove_event_detect(CAMERA_BUTTON_PIN)
-        GPIO.remove_event_detect(EXIT_BUTTON_PIN)
-
         #Get filenames for images
         filename = get_base_filename_for_images()
 
         photo_filenames = []
 
         prep_for_photo_screen(1)
-        remove_overlay(overlay)
-
-        if(taken_photo%10 == 0):
-            play_sound(SOUND_COUNTDOWN_0)
-        elif(taken_photo%10 == 1):
-            play_sound(SOUND_COUNTDOWN_1)
-        elif(taken_photo%10 == 2):
-            play_sound(SOUND_COUNTDOWN_2)
-        elif(taken_photo%10 == 3):
-            play_sound(SOUND_COUNTDOWN_3)
+        overlay.layer = HIDDEN_LAYER
+
+        play_sound(COUNTDOWN_SOUNDS[taken_photo % len(COUNTDOWN_SOUNDS)])
         fname = taking_photo(1, filename)
         photo_filenames.append(fname)
 
@@ -394,18 +588,14 @@ def main():
 
         #All done
         done_sound(taken_photo)
-        finished_image = REAL_PATH + '/assets/all_done.png'
-        finished_overlay = overlay_image(finished_image, 0, 4)
-        overlay = overlay_image(intro_image, 0, 3)
+        finished_overlay.layer = 4
+        overlay.layer = 3
 
         sleep(2)
-        remove_overlay(finished_overlay)
+        finished_overlay.layer = HIDDEN_LAYER
 
         #Save photos into additional folders (for post-processing/backup... etc.)
-        for dest in COPY_IMAGES_TO:
-            for src in photo_filenames:
-                print(src + ' -> ' + dest)
-                copy2(src, dest)
+        copy_images(photo_filenames)
 
         # If we were doing a test run, exit here.
         if TESTMODE_AUTOPRESS_BUTTON:
@@ -413,8 +603,6 @@ def main():
 
         taken_photo += 1
         # Otherwise, display intro screen again
-        GPIO.add_event_detect(CAMERA_BUTTON_PIN, GPIO.FALLING)
-        GPIO.add_event_detect(EXIT_BUTTON_PIN, GPIO.FALLING)
         print('Press the button to take a photo')
 
 if __name__ == "__main__":
@@ -427,5 +615,6 @@ if __name__ == "__main__":
     finally:
         CAMERA.stop_preview()
         CAMERA.close()
-        GPIO.cleanup()
+        CAMERA_BUTTON.close()
+        EXIT_BUTTON.close()
         sys.exit()